@@ -2,17 +2,138 @@ import os
 import sys
 import time
 import re
-from typing import Set
+import textwrap
+import threading
+from functools import lru_cache
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime, timedelta, timezone
+from typing import Iterable, Iterator, Optional, Set
 
 import arrow
 import caldav
-import ics
+import icalendar
 import requests
-from ics.icalendar import Event
+from requests.adapters import HTTPAdapter
 from dateutil.rrule import rrulestr
 from dateutil.parser import parse
-from dateutil.tz import tzutc
+from dateutil.tz import gettz, tzutc
 
+MAX_WORKERS = 16
+SYNC_WINDOW = timedelta(days=365)
+FULL_FETCH_EVERY = timedelta(days=1)
+REQUEST_TIMEOUT = 30
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+
+
+def _mount_pool(session: requests.Session, **kwargs):
+    """
+    Sizes the connection pool for the worker threads, the default
+    pool keeps only 10 connections and opens a new one for the rest.
+    """
+    for prefix in ("https://", "http://"):
+        session.mount(
+            prefix,
+            HTTPAdapter(pool_connections=MAX_WORKERS, pool_maxsize=MAX_WORKERS, **kwargs),
+        )
+
+
+# one session for all ICS downloads so connections are kept alive and reused
+_SESSION = requests.Session()
+_mount_pool(_SESSION, max_retries=3)
+
+_UID_RE = re.compile(r"^UID:(.+?)\r?$", re.M)
+_FOLD_RE = re.compile(r"\r?\n[ \t]")
+_ESCAPED_RE = re.compile(r"\\([\\;,nN])")
+_DTEND_RE = re.compile(r"DTEND[^:]*:(\d{8})")
+_RECURRING_RE = re.compile(r"(RRULE|RDATE)[;:]")
+
+
+@lru_cache(maxsize=4096)
+def _parse_rrule_until(rrule_str: str, dtstart_iso: str):
+    """
+    Recurring events tend to share their RRULE and start,
+    so parse each combination only once.
+    """
+    dtstart = parse(dtstart_iso)
+    try:
+        return rrulestr(rrule_str, dtstart=dtstart)._until
+    except ValueError:
+        # floating UNTIL with a zoned DTSTART, read it in the DTSTART's zone
+        until = rrulestr(rrule_str, dtstart=dtstart.replace(tzinfo=None))._until
+        return until.replace(tzinfo=dtstart.tzinfo)
+
+
+def _wall_clock(value) -> datetime:
+    """
+    Returns the naive wall clock time of a DTSTART/DTEND value,
+    all-day dates become midnight. This tool relabels the wall clock
+    time of every event as Europe/Helsinki anyway.
+    """
+    if not isinstance(value, datetime):
+        return datetime(value.year, value.month, value.day)
+    return value.replace(tzinfo=None)
+
+
+def _zone(prop):
+    """
+    Returns the timezone of a DATE-TIME property: its TZID when dateutil
+    knows it, UTC for a Z time, None for unknown TZIDs and floating times.
+    """
+    tzid = prop.params.get("TZID")
+    return gettz(tzid) if tzid else prop.dt.tzinfo
+
+
+def _instant(prop) -> datetime:
+    """
+    Reads a DTSTART/DTEND the way ics library used to, so the event UIDs
+    built from it don't change: UTC times and TZIDs known to dateutil
+    give the real instant, anything else (unknown TZIDs even with a VTIMEZONE
+    in the feed, floating times, all-day dates) has its wall clock read as UTC.
+    """
+    value = prop.dt
+    if isinstance(value, datetime) and (zone := _zone(prop)) is not None:
+        return value.replace(tzinfo=None).replace(tzinfo=zone)
+    return _wall_clock(value).replace(tzinfo=tzutc())
+
+
+def _unescape(value: str) -> str:
+    """
+    Undoes the TEXT escaping of a raw property value, icalendar escapes
+    the UIDs it writes and they have to match the ones it was given.
+    """
+    return _ESCAPED_RE.sub(lambda m: "\n" if m.group(1) in "nN" else m.group(1), value)
+
+
+def _drop_past_events(lines: Iterable[str], now: datetime) -> Iterator[str]:
+    """
+    Cheaply removes the VEVENT blocks which ended before yesterday
+    from the raw ICS lines, so icalendar doesn't have to parse years of history
+    and they never pile up in memory while downloading.
+    Recurring events and anything without a readable DTEND are kept,
+    the exact filtering happens after parsing.
+    """
+    cutoff = (now - timedelta(days=1)).strftime("%Y%m%d")
+    block = None
+
+    for line in lines:
+        if block is None:
+            if line.rstrip() == "BEGIN:VEVENT":
+                block = [line]
+            else:
+                yield line
+            continue
+
+        block.append(line)
+        if line.rstrip() != "END:VEVENT":
+            continue
+
+        ends = [m.group(1) for l in block if (m := _DTEND_RE.match(l))]
+        if not ends or any(_RECURRING_RE.match(l) for l in block) or ends[0] >= cutoff:
+            yield from block
+        block = None
+
+    if block is not None:
+        yield from block
 
 
 class ICSToCalDAV:
@@ -47,100 +168,223 @@ class ICSToCalDAV:
             url=local_url,
             auth=(local_username.encode(), local_password.encode()),
         )
+        # keep a connection per upload worker alive for all the PUTs and DELETEs
+        _mount_pool(self.local_client.session)
 
         self.local_calendar = self.local_client.principal().calendar(
             local_calendar_name
         )
+        self._print_lock = threading.Lock()
+
+        self.remote_urls = remote_urls
+        self.remote_auth = (remote_username.encode(), remote_password.encode())
+        self._ics_texts = {}
+        self._validators = {}
+        self._last_full_fetch = None
+        self._fetch_remote()
+
+    def _fetch_remote(self):
+        """
+        Downloads and parses the remote calendars again, so a single
+        instance can be synchronised repeatedly while keeping
+        the CalDAV principal and calendar lookups.
+        Unchanged calendars answer 304 to the conditional requests;
+        when all of them do, there's nothing to parse or synchronise.
+        Once every FULL_FETCH_EVERY everything is downloaded anyway,
+        so events moving into the sync window get uploaded.
+        """
+        now = datetime.now(timezone.utc)
+        conditional = (
+            self._last_full_fetch is not None
+            and now - self._last_full_fetch < FULL_FETCH_EVERY
+        )
+        if not conditional:
+            self._last_full_fetch = now
+
+        # download all the calendars at once, then parse them
+        with ThreadPoolExecutor(max_workers=max(1, min(len(self.remote_urls), MAX_WORKERS))) as executor:
+            ics_texts = list(
+                executor.map(lambda u: self._download(u[0], conditional, now), self.remote_urls)
+            )
+
+        self.remote_changed = any(ics_text is not None for ics_text in ics_texts)
+        if not self.remote_changed:
+            return
 
         self.remote_calendars = {}
-        for url, id in remote_urls:
+        for (url, id), ics_text in zip(self.remote_urls, ics_texts):
+            if ics_text is None:
+                ics_text = self._ics_texts[url]
+            self._ics_texts[url] = ics_text
+
+            remote_calendar = icalendar.Calendar.from_ical(ics_text)
             self.remote_calendars[url] = {
-                "calendar": ics.Calendar(
-                    requests.get(
-                        url,
-                        auth=(remote_username.encode(), remote_password.encode()),
-                    ).text
-                ),
+                "events": self._get_upcoming_events(remote_calendar, now),
                 "id": id
             }
 
-    def _get_local_events_ids(self) -> Set[int]:
+    def _download(self, url: str, conditional: bool, now: datetime) -> Optional[str]:
+        """
+        Streams the ICS file and drops the past events line by line
+        as it arrives, instead of buffering the whole body first.
+        Returns None when conditional and the server says 304 Not Modified.
+        """
+        headers = self._validators.get(url, {}) if conditional else {}
+        with _SESSION.get(
+            url,
+            auth=self.remote_auth,
+            headers=headers,
+            timeout=REQUEST_TIMEOUT,
+            stream=True,
+        ) as response:
+            if response.status_code == 304:
+                return None
+
+            validators = {}
+            if etag := response.headers.get("ETag"):
+                validators["If-None-Match"] = etag
+            if last_modified := response.headers.get("Last-Modified"):
+                validators["If-Modified-Since"] = last_modified
+            self._validators[url] = validators
+
+            encoding = response.encoding or "utf-8"
+            lines = (
+                line.decode(encoding)
+                for line in response.iter_lines(chunk_size=DOWNLOAD_CHUNK_SIZE)
+            )
+            return "\n".join(_drop_past_events(lines, now))
+
+    def _get_local_events_ids(self, now: datetime) -> Set[str]:
         """
         This piece of crap:
         1) Gets from the local calendar all the events ocurring after now,
-        2) Loads them to ics library so their UID can be pulled,
-        3) Pulls all of the UIDs and returns them.
+        2) Fetches the data the server left out of the search results
+           with a single multiget, not one GET per event,
+        3) Unfolds their raw data and scans it for the UID line,
+           no need to parse the whole calendar just for that,
+        4) Returns all of the UIDs.
         """
-        local_events = self.local_calendar.date_search(arrow.utcnow())
-        local_events_ids = set(
-            next(iter(ics.Calendar(e.data).events)).uid for e in local_events
+        local_events = self.local_calendar.search(
+            start=now,
+            end=now + SYNC_WINDOW,
+            event=True,
+            expand=False,
         )
-        return local_events_ids
 
-    @staticmethod
-    def _wrap(vevent: str) -> str:
+        missing = [e.url for e in local_events if not e.data]
+        if missing:
+            local_events = [e for e in local_events if e.data]
+            local_events += self.local_calendar.calendar_multiget(missing)
+
+        return {
+            _unescape(m.group(1)) for e in local_events
+            if e.data and (m := _UID_RE.search(_FOLD_RE.sub("", e.data)))
+        }
+
+    # the timezone around each event never changes, so parse it once and share it
+    _VTIMEZONE = icalendar.Timezone.from_ical(textwrap.dedent("""\
+        BEGIN:VTIMEZONE
+        TZID:Europe/Helsinki
+        BEGIN:DAYLIGHT
+        TZOFFSETFROM:+0200
+        RRULE:FREQ=YEARLY;BYMONTH=3;BYDAY=-1SU
+        DTSTART:19810329T030000
+        TZNAME:EEST
+        TZOFFSETTO:+0300
+        END:DAYLIGHT
+        BEGIN:STANDARD
+        TZOFFSETFROM:+0300
+        RRULE:FREQ=YEARLY;BYMONTH=10;BYDAY=-1SU
+        DTSTART:19811025T040000
+        TZNAME:EET
+        TZOFFSETTO:+0200
+        END:STANDARD
+        END:VTIMEZONE
+    """))
+
+    @classmethod
+    def _wrap(cls, vevent: icalendar.Event) -> icalendar.Calendar:
         """
         Since CalDAV expects a VEVENT in a VCALENDAR,
         we need to wrap each event pulled from a single ICS
         into its own calendar. Also added VTIMEZONE.
+        The calendar is handed to caldav as an object, so it doesn't
+        have to parse back the text we'd serialise.
         """
-        vtimezone = """
-            BEGIN:VTIMEZONE
-            TZID:Europe/Helsinki
-            BEGIN:DAYLIGHT
-            TZOFFSETFROM:+0200
-            RRULE:FREQ=YEARLY;BYMONTH=3;BYDAY=-1SU
-            DTSTART:19810329T030000
-            TZNAME:EEST
-            TZOFFSETTO:+0300
-            END:DAYLIGHT
-            BEGIN:STANDARD
-            TZOFFSETFROM:+0300
-            RRULE:FREQ=YEARLY;BYMONTH=10;BYDAY=-1SU
-            DTSTART:19811025T040000
-            TZNAME:EET
-            TZOFFSETTO:+0200
-            END:STANDARD
-            END:VTIMEZONE
-        """
-        result = f"""
-            BEGIN:VCALENDAR
-            VERSION:2.0
-            PRODID:-//Chihiro Software Ltd//Calendar sync//EN
-            {vtimezone}
-            {vevent}
-            END:VCALENDAR
-        """
-        return "\n".join(line.lstrip() for line in result.split("\n"))
+        wrapper = icalendar.Calendar()
+        wrapper.add("VERSION", "2.0")
+        wrapper.add("PRODID", "-//Chihiro Software Ltd//Calendar sync//EN")
+        wrapper.add_component(cls._VTIMEZONE)
+        wrapper.add_component(vevent)
+        return wrapper
 
 
     @staticmethod
-    def get_event_end(vevent):
+    def get_event_begin(vevent: icalendar.Event) -> datetime:
+        return _instant(vevent["DTSTART"])
+
+    @classmethod
+    def get_event_end(cls, vevent: icalendar.Event, begin: Optional[datetime] = None) -> datetime:
         """
         Event end date might be earlier than the until date, 
         the actual end date of recurring event. Find latest.
+        Pass begin when it's already known.
         """
-        rrule_str = None
         until_date = None
+        if begin is None:
+            begin = cls.get_event_begin(vevent)
+
+        # end is DTEND, or DTSTART plus DURATION, or the whole day for all-day events
+        if "DTEND" in vevent:
+            end = _instant(vevent["DTEND"])
+        elif "DURATION" in vevent:
+            end = begin + vevent["DURATION"].dt
+        elif not isinstance(vevent["DTSTART"].dt, datetime):
+            end = begin + timedelta(days=1)
+        else:
+            end = begin
 
         # find RRULE
-        event_str = vevent.serialize()
-        for line in event_str.splitlines():
-            if line.startswith('RRULE:'):
-                rrule_str = line.split("RRULE:")[1]
+        rrule = vevent.get("RRULE")
+        if isinstance(rrule, list):
+            rrule = rrule[-1]
 
         # find until date
-        if rrule_str:
-            rrule = rrulestr(rrule_str, dtstart=vevent.begin.datetime)
-            until_date = rrule._until
+        if rrule is not None:
+            until_date = _parse_rrule_until(rrule.to_ical().decode(), begin.isoformat())
 
         # get actual end date
-        max_date = vevent.end if until_date is None else max(vevent.end, until_date)
+        max_date = end if until_date is None else max(end, until_date)
         # print('max_date',max_date)
 
         return max_date
 
 
+    @classmethod
+    def _get_upcoming_events(cls, remote_calendar: icalendar.Calendar, now: datetime) -> list:
+        """
+        Drops the events which are already over or start after the
+        sync window, the same window the local calendar is searched with.
+        ICS hosts can't filter server side, so do it right after download.
+        Returns (event, begin) pairs, so the start instant worked out here
+        is reused for the UID instead of being read again.
+        """
+        window_end = now + SYNC_WINDOW
+        upcoming = []
+        for event in remote_calendar.walk("VEVENT"):
+            begin = cls.get_event_begin(event)
+            if now <= cls.get_event_end(event, begin) and begin <= window_end:
+                upcoming.append((event, begin))
+        return upcoming
+
+    def _progress(self, mark: str):
+        """
+        Prints a progress mark, safe to call from the worker threads.
+        """
+        with self._print_lock:
+            print(mark, end="")
+            sys.stdout.flush()
+
     def synchronise(self):
         """
         The main function which:
@@ -149,68 +393,127 @@ class ICSToCalDAV:
         3) Removes local events which are not in the remote any more.
         """
         
-        print(f".synchronise started at {arrow.utcnow().to('Europe/Helsinki')}")
+        now = arrow.utcnow()
+        print(f".synchronise started at {now.to('Europe/Helsinki')}")
+        if not self.remote_changed:
+            print("..remote calendars not modified, skipping")
+            return
+
+        # a failed or interrupted sync must not be skipped as not modified next time,
+        # so the validators only come back once every upload and delete went through
+        validators, self._validators = self._validators, {}
+        failures = 0
+
         remote_events_ids = set()
+        wrapped = []
 
         for idx, (url, remote_calendar_info) in enumerate(self.remote_calendars.items()):
 
-            remote_calendar = remote_calendar_info["calendar"]
+            remote_events = remote_calendar_info["events"]
             id = remote_calendar_info["id"]
             print() if idx > 0 else None
             print(f'..processing calendar {id}: ', end="")
 
-            for remote_event in remote_calendar.events:
-
-                max_date = self.get_event_end(remote_event)
-
-                if arrow.utcnow().to('Europe/Helsinki') <= max_date:
-
+            for remote_event, begin in remote_events:
+
+                try:
+                    uid = str(remote_event.get("UID"))
+
+                    # prefix name with id
+                    name = f"{id}:{remote_event.pop('SUMMARY', None)}"
+                    remote_event.add("SUMMARY", name)
+
+                    # create unique UID for recurring events, from the start instant of the filter pass
+                    new_uid = f"{id}_{uid}" + '||' + str(begin.timestamp())
+
+                    # force unique UID for recurring events, keep each event and don't replace based on original UID
+                    remote_event.pop("UID", None)
+                    remote_event.add("UID", new_uid)
+                    remote_event.pop("RECURRENCE-ID", None)
+
+                    # use my timezone, keep the wall clock time
+                    dtstart = remote_event["DTSTART"]
+                    if isinstance(dtstart.dt, datetime):
+                        for prop in ("DTSTART", "DTEND"):
+                            if prop in remote_event:
+                                wall_clock = _wall_clock(remote_event.pop(prop).dt)
+                                remote_event.add(prop, wall_clock, parameters={"TZID": "Europe/Helsinki"})
+
+                        # relabel the exceptions the same way or they won't match the instances,
+                        # a time in another zone is moved to the start's zone first if that one is known
+                        zone, tzid = _zone(dtstart), dtstart.params.get("TZID")
+                        for prop in ("EXDATE", "RDATE"):
+                            dates = remote_event.get(prop, [])
+                            for date_list in dates if isinstance(dates, list) else [dates]:
+                                if all(isinstance(d.dt, datetime) for d in date_list.dts):
+                                    convert = zone is not None and date_list.params.get("TZID") != tzid
+                                    for d in date_list.dts:
+                                        if convert and d.dt.tzinfo is not None:
+                                            d.dt = d.dt.astimezone(zone)
+                                        d.dt = _wall_clock(d.dt)
+                                    date_list.params["TZID"] = "Europe/Helsinki"
+
+                    for value in remote_event.values():
+                        for prop in value if isinstance(value, list) else [value]:
+                            params = getattr(prop, "params", {})
+                            if params.get("TZID") == "FLE Standard Time":
+                                params["TZID"] = "Europe/Helsinki"
+
+                    # add remote event to the set
+                    remote_events_ids.add(new_uid)
+
+                    # check the event
+                    # print(self._wrap(remote_event).to_ical().decode())
+
+                    wrapped.append((new_uid, self._wrap(remote_event)))
+
+                except Exception as e:
+                    print(f"Failed to process event {remote_event.get('UID')}: {e}")
+                    continue
+
+        with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+
+            # upload events in parallel, each save is a blocking PUT
+            print("\n..uploading events: ", end="") if len(wrapped) > 0 else None
+            futures = {
+                executor.submit(self.local_calendar.save_event, event_ics): uid
+                for uid, event_ics in wrapped
+            }
+            for future in as_completed(futures):
+                try:
+                    future.result()
+                    self._progress("+")
+                except Exception as e:
+                    failures += 1
+                    with self._print_lock:
+                        print(f"Failed to save event {futures[future]}: {e}")
+
+            # delete events not in remote calendar, nothing to do when already in sync
+            events_to_delete = self._get_local_events_ids(now.datetime) - remote_events_ids
+            if events_to_delete:
+                print("\n..deleting events: ", end="")
+
+                futures = {
+                    executor.submit(
+                        self.local_client.delete,
+                        f"{self.local_calendar.url}{local_event_id}.ics",
+                    ): local_event_id
+                    for local_event_id in events_to_delete
+                }
+                for future in as_completed(futures):
                     try:
-                        # prefix name with id
-                        remote_event.name = f"{id}:{remote_event.name}"
-
-                        # create unique UID for recurring events
-                        new_uid = f"{id}_{remote_event.uid}" + '||' + str(remote_event.begin.timestamp())
-
-                        # force unique UID for recurring events, keep each event and don't replace based on original UID
-                        event_str = remote_event.serialize()
-                        event_str = re.sub(r"UID:[^\n]+",f"UID:{new_uid}",event_str) # replace uid, match "UID:" plus any chars but newline
-                        event_str = re.sub(r"RECURRENCE-ID.*\n", "", event_str) # replace recurrence line
-
-                        # use my timezone
-                        event_str = re.sub(r"DTSTART:[^\n]+", f"DTSTART;TZID=Europe/Helsinki:{remote_event.begin.strftime('%Y%m%dT%H%M%S')}", event_str)
-                        event_str = re.sub(r"DTEND:[^\n]+", f"DTEND;TZID=Europe/Helsinki:{remote_event.end.strftime('%Y%m%dT%H%M%S')}", event_str)
-                        event_str = re.sub(r"TZID=FLE Standard Time", f"TZID=Europe/Helsinki", event_str)
-
-                        # add remote event to the set
-                        remote_events_ids.add(new_uid)
-
-                        # check the event
-                        # print(self._wrap(event_str))
-
-                        self.local_calendar.save_event(self._wrap(event_str))
-                        # print(f"+{remote_event.name} ({remote_event.begin})\n", end="")
-                        print("+", end="")
-                        sys.stdout.flush()
-                            
+                        future.result()
+                        # print(f"-{futures[future]}\n", end="")
+                        self._progress("-")
                     except Exception as e:
-                        print(f"Failed to process event {remote_event.uid}: {e}")
-                        continue
-        
-        # delete events not in remote calendar
-        local_events_ids = set(self._get_local_events_ids())
-        events_to_delete = local_events_ids - remote_events_ids
-        print("\n..deleting events: ", end="") if len(events_to_delete) > 0 else None
-
-        for local_event_id in events_to_delete:
-            self.local_client.delete(
-                f"{self.local_calendar.url}{local_event_id}.ics"
-            )
-            # print(f"-{local_event_id}\n", end="")
-            print(f"-", end="")
-            sys.stdout.flush()
+                        failures += 1
+                        with self._print_lock:
+                            print(f"Failed to delete event {futures[future]}: {e}")
         print()
 
+        if not failures:
+            self._validators = validators
+
        
 def getenv_or_raise(var):
     if (value := os.getenv(var)) is None:
@@ -244,13 +547,15 @@ if __name__ == "__main__":
     else:
         print('.run once')
 
+    syncer = ICSToCalDAV(**settings)
+
     while True:
         if sync_every is None:
             next_run = None
         else:
             next_run = arrow.utcnow().dehumanize(sync_every)
 
-        ICSToCalDAV(**settings).synchronise()
+        syncer.synchronise()
 
         if next_run is None:
             break
@@ -260,3 +565,4 @@ if __name__ == "__main__":
             print(f'.next sync at {next_run_time} (in {seconds_to_next}s)')
             if seconds_to_next > 0:
                 time.sleep(seconds_to_next)
+            syncer._fetch_remote()